@@ -0,0 +1,107 @@
+"""
+Benchmark HFEngine load options on CPU.
+Every option set is loaded in a fresh process and reports
+load time, peak resident memory and generation speed.
+
+Usage:
+    python benchmarks/hf_engine_load_options.py --model HuggingFaceTB/SmolLM2-135M-Instruct
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import resource
+import time
+from typing import Any, Dict
+
+OPTIONS: Dict[str, Dict[str, Any]] = {
+    "default": {},
+    "bfloat16": {"torch_dtype": "bfloat16"},
+    "eager attention": {"attn_implementation": "eager"},
+    "sdpa attention": {"attn_implementation": "sdpa"},
+    "static cache": {"cache_implementation": "static"},
+    "static cache + compile": {
+        "cache_implementation": "static",
+        "torch_compile": True,
+    },
+}
+
+
+def peak_rss_mib() -> float:
+    """Peak resident memory of the current process in MiB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def generate(engine, max_new_tokens: int) -> str:
+    """Generate a reply to a fixed prompt"""
+    # pylint: disable=import-outside-toplevel
+    from AGISwarm.llm_instruct_ms.llm_engines import HFSamplingParams
+
+    reply = ""
+    async for _, text in engine.generate(
+        [{"role": "user", "content": "Tell me a long story about a dragon."}],
+        sampling_params=HFSamplingParams(max_new_tokens=max_new_tokens),
+    ):
+        reply += text
+    return reply
+
+
+def run(model: str, options: Dict[str, Any], max_new_tokens: int, queue):
+    """Load the engine with options and measure it"""
+    # pylint: disable=import-outside-toplevel
+    from AGISwarm.llm_instruct_ms.llm_engines import HFEngine
+
+    start = time.perf_counter()
+    engine = HFEngine(hf_model_name=model, tokenizer_name=None, **options)
+    load_time = time.perf_counter() - start
+    load_rss = peak_rss_mib()
+    # Warm-up, e.g. for torch.compile
+    asyncio.run(generate(engine, 8))
+    start = time.perf_counter()
+    reply = asyncio.run(generate(engine, max_new_tokens))
+    generation_time = time.perf_counter() - start
+    tokens = len(engine.tokenizer(reply, add_special_tokens=False).input_ids)
+    queue.put(
+        {
+            "load_time": load_time,
+            "load_rss": load_rss,
+            "peak_rss": peak_rss_mib(),
+            "tokens_per_second": tokens / generation_time,
+        }
+    )
+
+
+def main():
+    """Run the benchmark for every option set"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default="HuggingFaceTB/SmolLM2-135M-Instruct")
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    args = parser.parse_args()
+    # Benchmark on CPU
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+    context = multiprocessing.get_context("spawn")
+    print(
+        f"{'options':<24} {'load, s':>8} {'load RSS, MiB':>14} "
+        f"{'peak RSS, MiB':>14} {'tokens/s':>9}"
+    )
+    for name, options in OPTIONS.items():
+        queue = context.Queue()
+        process = context.Process(
+            target=run, args=(args.model, options, args.max_new_tokens, queue)
+        )
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            print(f"{name:<24} failed with exit code {process.exitcode}")
+            continue
+        result = queue.get()
+        print(
+            f"{name:<24} {result['load_time']:>8.2f} {result['load_rss']:>14.0f} "
+            f"{result['peak_rss']:>14.0f} {result['tokens_per_second']:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
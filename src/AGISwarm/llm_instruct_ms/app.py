@@ -2,23 +2,40 @@
 
 import asyncio
 import base64
+import contextlib
+import gc
+import ipaddress
+import json
 import logging
 import re
+import secrets
 import uuid
 from io import BytesIO
 from pathlib import Path
-from typing import Any, Dict, cast
+from typing import Any, Dict, Literal, Optional, Tuple, cast
 
 from AGISwarm.asyncio_queue_manager import AsyncIOQueueManager, TaskStatus
-from fastapi import APIRouter, FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi import (
+    APIRouter,
+    Depends,
+    FastAPI,
+    HTTPException,
+    Request,
+    WebSocket,
+    WebSocketDisconnect,
+)
+from fastapi.responses import FileResponse, HTMLResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
+from fastapi.websockets import WebSocketState
 from jinja2 import Environment, FileSystemLoader
 from omegaconf import OmegaConf
 from PIL import Image
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 from .llm_engines import ConcurrentEngine, Engine
+from .profiling import cprofile_event_loop, sample_stacks
+from .sessions import Generation, SessionManager
+from .tracing import tracer
 from .typing import (
     ENGINE_MAP,
     ENGINE_SAMPLING_PARAMS_MAP,
@@ -27,27 +44,42 @@ from .typing import (
 )
 
 
-class LLMInstructApp:  # pylint: disable=too-few-public-methods
+class LLMInstructApp:  # pylint: disable=too-few-public-methods, too-many-instance-attributes, too-many-public-methods
     """Application factory"""
 
     def __init__(self, config: LLMInstructConfig):
         self.config = config
         self.app = FastAPI()
-        if config.engine_config is None:
-            config.engine_config = cast(None, OmegaConf.create())
-        self.llm_pipeline: Engine[Any] = ENGINE_MAP[config.engine](  # type: ignore
-            hf_model_name=config.hf_model_name,
-            tokenizer_name=config.tokenizer_name,
-            **cast(dict, OmegaConf.to_container(config.engine_config)),
-        )
+        self.llm_pipeline = self.load_engine(config)
         self.sampling_settings_cls = ENGINE_SAMPLING_PARAMS_MAP[config.engine]
         self.queue_manager = AsyncIOQueueManager(
             max_concurrent_tasks=2,
             sleep_time=0.001,
         )
         self.start_abort_lock = asyncio.Lock()
+        # In-flight generations: request id -> (engine, task id)
+        self.inflight: Dict[str, Tuple[Any, Optional[str]]] = {}
+        self.reload_task: Optional[asyncio.Task] = None
+        self.reload_error: Optional[str] = None
+        self.profile_lock = asyncio.Lock()
+        self.sessions = SessionManager(ttl=config.session_config.ttl)
+        self.sweep_task: Optional[asyncio.Task] = None
+        tracer.configure(
+            config.tracing_config.file if config.tracing_config.enabled else None
+        )
         self.setup_routes()
 
+    @staticmethod
+    def load_engine(config: LLMInstructConfig) -> Engine[Any]:
+        """Load the LLM engine from config"""
+        if config.engine_config is None:
+            config.engine_config = cast(None, OmegaConf.create())
+        return ENGINE_MAP[config.engine](  # type: ignore
+            hf_model_name=config.hf_model_name,
+            tokenizer_name=config.tokenizer_name,
+            **cast(dict, OmegaConf.to_container(config.engine_config)),
+        )
+
     def setup_routes(self):
         """
         Set up the routes for the Text2Imag e service.
@@ -61,7 +93,16 @@ class LLMInstructApp:  # pylint: disable=too-few-public-methods
         self.ws_router = APIRouter()
         self.ws_router.add_websocket_route("/ws", self.generate)
         self.app.post("/abort")(self.abort)
+        self.app.get("/metrics")(self.metrics)
+        admin = [Depends(self.verify_admin)]
+        self.app.post("/admin/reload", dependencies=admin)(self.reload)
+        self.app.get("/admin/status", dependencies=admin)(self.status)
+        self.app.post(
+            "/admin/profile", response_class=PlainTextResponse, dependencies=admin
+        )(self.profile)
         self.app.include_router(self.ws_router)
+        self.app.add_event_handler("startup", self.start_session_sweep)
+        self.app.add_event_handler("shutdown", self.stop_session_sweep)
 
     async def gui(self):
         """Root endpoint. Serves gui/index.html"""
@@ -108,49 +149,149 @@ class LLMInstructApp:  # pylint: disable=too-few-public-methods
     async def generate(self, websocket: WebSocket):  # type: ignore
         """WebSocket endpoint"""
         await websocket.accept()
-        conversation_id = str(uuid.uuid4())
+        offset = websocket.query_params.get("offset")
+        if offset is not None and not offset.isdigit():
+            await websocket.close(code=1008, reason="offset must be a non-negative int")
+            return
+        token = websocket.query_params.get("session_token")
+        session = self.sessions.attach(token)
         try:
-            while True:
-                data: Dict[str, Any] = await websocket.receive_json()
-                gen_config = SamplingConfig(data)
-                sampling_dict = self.sampling_settings_cls.model_validate(
-                    gen_config,
-                    strict=False,
+            await websocket.send_json(
+                {
+                    "status": "session",
+                    "session_token": session.token,
+                    "resumed": session.token == token,
+                }
+            )
+            # Replay the generation that was running when the client disconnected
+            if session.generation is not None and (
+                not session.generation.finished or offset is not None
+            ):
+                await self.send_generation(
+                    websocket, session.generation, int(offset or 0)
                 )
-                image: Image.Image | None = (
-                    self.base64_to_image(gen_config.image) if gen_config.image else None
+            while True:
+                message = await websocket.receive_text()
+                generation = Generation()
+                session.generation = generation
+                # The generation goes on if the client disconnects
+                generation.task = asyncio.create_task(
+                    self.handle_request(generation, session.conversation_id, message)
                 )
-                # Enqueue the task (without starting it)
-                queued_task = self.queue_manager.queued_task(
-                    self.llm_pipeline.__call__,
-                    pass_task_id=isinstance(
-                        self.llm_pipeline, ConcurrentEngine  # type: ignore
-                    ),
-                    warnings=(
-                        ["Image input not supported by this model"]
-                        if image and not self.llm_pipeline.image_prompt_enabled
-                        else None
-                    ),
-                    raise_on_error=False,
-                    print_error_tracebacks=True,
+                await self.send_generation(websocket, generation)
+        # Sending to a dropped client raises OSError on some Starlette versions
+        except (WebSocketDisconnect, OSError):
+            logging.info("Client %s disconnected", session.conversation_id)
+        finally:
+            self.sessions.detach(session)
+            if websocket.application_state == WebSocketState.CONNECTED:
+                # The transport may already be gone after a failed send
+                with contextlib.suppress(RuntimeError, OSError):
+                    await websocket.close()
+
+    async def send_generation(
+        self, websocket: WebSocket, generation: Generation, offset: int = 0
+    ):
+        """Send the steps of the generation from offset until it is finished"""
+        async for step_info in generation.stream(offset):
+            await websocket.send_json(step_info)
+
+    async def start_session_sweep(self):
+        """Start expiring detached sessions in the background"""
+        self.sweep_task = asyncio.create_task(self.sweep_sessions())
+
+    async def stop_session_sweep(self):
+        """Stop expiring sessions"""
+        if self.sweep_task is not None:
+            self.sweep_task.cancel()
+
+    async def sweep_sessions(self):
+        """Expire sessions every sweep_interval, even when no client connects"""
+        while True:
+            await asyncio.sleep(self.config.session_config.sweep_interval)
+            try:
+                await self.expire_sessions()
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Session sweep failed")
+
+    async def expire_sessions(self):
+        """Drop the expired sessions, their conversations and generations"""
+        for session in self.sessions.pop_expired():
+            logging.info("Session %s expired", session.conversation_id)
+            generation = session.generation
+            if generation is not None and not generation.finished:
+                task_id = (
+                    generation.steps[-1].get("task_id") if generation.steps else None
                 )
-                # task_id and interrupt_event are created by the queued_generator
-                async for step_info in queued_task(
-                    conversation_id,
-                    gen_config.prompt,
-                    gen_config.system_prompt,
-                    gen_config.reply_prefix,
-                    image,
-                    sampling_dict,
-                ):
-                    if step_info["status"] == TaskStatus.ERROR:
-                        step_info["content"] = None
-                    await websocket.send_json(step_info)
-        except WebSocketDisconnect:
-            logging.info("Client %s disconnected", conversation_id)
+                if task_id is not None:
+                    async with self.start_abort_lock:
+                        await self.queue_manager.abort_task(task_id)
+            self.llm_pipeline.conversations.pop(session.conversation_id, None)
+
+    async def handle_request(
+        self, generation: Generation, conversation_id: str, message: str
+    ):
+        """Generate a reply to the websocket message into the generation buffer"""
+        try:
+            with tracer.start_span("request", conversation_id=conversation_id):
+                await self.run_request(generation, conversation_id, message)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Request of %s failed", conversation_id)
+            generation.publish({"status": TaskStatus.ERROR, "content": None})
+        finally:
+            generation.finish()
+
+    async def run_request(
+        self, generation: Generation, conversation_id: str, message: str
+    ):
+        """Parse the request and run it through the queue"""
+        with tracer.start_span("parse_request"):
+            data: Dict[str, Any] = json.loads(message)
+            gen_config = SamplingConfig(data)
+            # Requests stick to the engine they started on during a reload
+            engine = self.llm_pipeline
+            sampling_dict = self.sampling_settings_cls.model_validate(
+                gen_config,
+                strict=False,
+            )
+        with tracer.start_span("base64_to_image"):
+            image: Image.Image | None = (
+                self.base64_to_image(gen_config.image) if gen_config.image else None
+            )
+        # Enqueue the task (without starting it)
+        queued_task = self.queue_manager.queued_task(
+            engine.__call__,
+            pass_task_id=isinstance(engine, ConcurrentEngine),  # type: ignore
+            warnings=(
+                ["Image input not supported by this model"]
+                if image and not engine.image_prompt_enabled
+                else None
+            ),
+            raise_on_error=False,
+            print_error_tracebacks=True,
+        )
+        request_id = str(uuid.uuid4())
+        self.inflight[request_id] = (engine, None)
+        queue_span = tracer.start_span("queue_wait")
+        try:
+            # task_id and interrupt_event are created by the queued_generator
+            async for step_info in queued_task(
+                conversation_id,
+                gen_config.prompt,
+                gen_config.system_prompt,
+                gen_config.reply_prefix,
+                image,
+                sampling_dict,
+            ):
+                self.inflight[request_id] = (engine, step_info.get("task_id"))
+                if step_info["status"] != TaskStatus.WAITING:
+                    queue_span.end()
+                if step_info["status"] == TaskStatus.ERROR:
+                    step_info["content"] = None
+                generation.publish(step_info)
         finally:
-            self.llm_pipeline.conversations.pop(conversation_id, None)
-            await websocket.close()
+            queue_span.end()
+            self.inflight.pop(request_id, None)
 
     class AbortRequest(BaseModel):
         """Abort request"""
@@ -162,3 +303,149 @@ class LLMInstructApp:  # pylint: disable=too-few-public-methods
         async with self.start_abort_lock:
             logging.info("Aborting task %s", request.task_id)
             await self.queue_manager.abort_task(request.task_id)
+
+    async def metrics(self) -> Dict[str, Any]:
+        """Engine metrics"""
+        return self.llm_pipeline.metrics()
+
+    async def verify_admin(self, request: Request):
+        """
+        Authorize admin endpoints: with the admin token if it is configured,
+        otherwise only for loopback clients.
+        """
+        token = self.config.admin_config.token
+        if token is not None:
+            authorization = request.headers.get("authorization", "")
+            if not secrets.compare_digest(
+                authorization.encode("utf-8"), f"Bearer {token}".encode("utf-8")
+            ):
+                raise HTTPException(status_code=401, detail="Invalid admin token")
+            return
+        try:
+            loopback = request.client is not None and (
+                ipaddress.ip_address(request.client.host).is_loopback
+            )
+        except ValueError:
+            loopback = False
+        if not loopback:
+            raise HTTPException(
+                status_code=403,
+                detail="Admin endpoints need admin_config.token for remote clients",
+            )
+
+    class ReloadRequest(BaseModel):
+        """Reload request. Unset fields are taken from the current config"""
+
+        hf_model_name: Optional[str] = None
+        tokenizer_name: Optional[str] = None
+        engine: Optional[Literal["HFEngine", "VLLMEngine", "LlamaCppEngine"]] = None
+        engine_config: Optional[Dict[str, Any]] = None
+        drain_timeout: float = 300.0
+
+    @staticmethod
+    def reload_config(
+        config: LLMInstructConfig, request: ReloadRequest
+    ) -> LLMInstructConfig:
+        """Merge the set fields of the reload request onto a copy of the config"""
+        config = cast(LLMInstructConfig, config.copy())
+        overrides = request.model_dump(exclude_unset=True, exclude={"drain_timeout"})
+        # Engine kwargs of another engine class do not apply to the new one
+        if overrides.get("engine", config.engine) != config.engine:
+            config.engine_config = None
+        # Neither does the tokenizer of another model
+        if overrides.get("hf_model_name", config.hf_model_name) != config.hf_model_name:
+            config.tokenizer_name = None
+        for key, value in overrides.items():
+            config[key] = OmegaConf.create(value) if key == "engine_config" else value
+        return config
+
+    async def reload(self, request: ReloadRequest):
+        """Load a new engine in the background and switch new requests to it"""
+        if self.reload_task is not None and not self.reload_task.done():
+            raise HTTPException(status_code=409, detail="Reload already in progress")
+        config = self.reload_config(self.config, request)
+        self.reload_error = None
+        self.reload_task = asyncio.create_task(
+            self.switch_engine(config, request.drain_timeout)
+        )
+        return {"status": "loading", "hf_model_name": config.hf_model_name}
+
+    async def switch_engine(self, config: LLMInstructConfig, drain_timeout: float):
+        """
+        Switch to the engine loaded from config, then free the old one
+        once its in-flight generations are finished.
+        """
+        logging.info("Loading %s in the background", config.hf_model_name)
+        try:
+            engine = await asyncio.to_thread(self.load_engine, config)
+        except Exception as error:  # pylint: disable=broad-except
+            logging.exception("Failed to load %s", config.hf_model_name)
+            self.reload_error = f"Failed to load {config.hf_model_name}: {error!r}"
+            return
+        old_engine = self.llm_pipeline
+        # Open conversations keep their history on the new engine. The dicts are
+        # shared, so conversations started by requests still queued on the old
+        # engine are seen by the new one and freed by expire_sessions.
+        engine.conversations = old_engine.conversations
+        engine.image = old_engine.image
+        self.llm_pipeline = engine
+        self.sampling_settings_cls = ENGINE_SAMPLING_PARAMS_MAP[config.engine]
+        self.config = config
+        logging.info("Switched to %s", config.hf_model_name)
+        await self.drain(old_engine, drain_timeout)
+        old_engine.close()
+        del old_engine
+        gc.collect()
+
+    async def drain(self, engine: Engine[Any], timeout: float):
+        """
+        Wait for in-flight generations on the engine, abort them on timeout
+        and wait for the aborted ones to exit.
+        """
+
+        async def wait_idle():
+            while any(inflight[0] is engine for inflight in self.inflight.values()):
+                await asyncio.sleep(0.1)
+
+        try:
+            await asyncio.wait_for(wait_idle(), timeout)
+        except asyncio.TimeoutError:
+            task_ids = [
+                task_id
+                for inflight_engine, task_id in self.inflight.values()
+                if inflight_engine is engine and task_id is not None
+            ]
+            logging.warning("Drain timed out, aborting %d generations", len(task_ids))
+            async with self.start_abort_lock:
+                for task_id in task_ids:
+                    await self.queue_manager.abort_task(task_id)
+            await wait_idle()
+
+    async def status(self) -> Dict[str, Any]:
+        """Current model and reload status"""
+        return {
+            "hf_model_name": self.config.hf_model_name,
+            "engine": self.config.engine,
+            "reloading": self.reload_task is not None and not self.reload_task.done(),
+            "last_reload_error": self.reload_error,
+            "inflight": len(self.inflight),
+        }
+
+    class ProfileRequest(BaseModel):
+        """Profile request"""
+
+        seconds: float = Field(default=10.0, gt=0.0, le=60.0)
+        mode: Literal["stack", "cprofile"] = "stack"
+
+    async def profile(self, request: ProfileRequest) -> str:
+        """
+        Profile the service for a bounded window.
+        "stack" samples the stacks of all threads and returns them collapsed,
+        "cprofile" profiles the event loop thread and returns its statistics.
+        """
+        if self.profile_lock.locked():
+            raise HTTPException(status_code=409, detail="Profiling already running")
+        async with self.profile_lock:
+            if request.mode == "cprofile":
+                return await cprofile_event_loop(request.seconds)
+            return await asyncio.to_thread(sample_stacks, request.seconds)
@@ -1,8 +1,24 @@
 
-let ws = new WebSocket(WEBSOCKET_URL);
-ws.onopen = function () {
-    console.log("WebSocket is open now.");
-};
+let ws = null;
+// Number of messages received for the current generation, to resume it after a reconnect
+let generationSteps = 0;
+
+function connect() {
+    let url = WEBSOCKET_URL;
+    const sessionToken = sessionStorage.getItem('session_token');
+    if (sessionToken !== null) {
+        url += "?session_token=" + encodeURIComponent(sessionToken) + "&offset=" + generationSteps;
+    }
+    ws = new WebSocket(url);
+    ws.onopen = function () {
+        console.log("WebSocket is open now.");
+    };
+    ws.onmessage = onMessage;
+    ws.onclose = function (event) {
+        console.log("WebSocket is closed now. Reconnecting...");
+        setTimeout(connect, 1000);
+    };
+}
 
 function resetForm() {
     document.getElementById('max_new_tokens').value = DEFAULT_MAX_NEW_TOKENS;
@@ -68,9 +84,17 @@ function updateBotMessage(message, replace = false) {
 }
 
 currentStatus = "idle";
-ws.onmessage = function (event) {
+function onMessage(event) {
     // Send button is disabled until the response is received
     response_dict = JSON.parse(event.data);
+    if (response_dict["status"] == "session") {
+        if (!response_dict["resumed"]) {
+            generationSteps = 0;
+        }
+        sessionStorage.setItem('session_token', response_dict["session_token"]);
+        return;
+    }
+    generationSteps += 1;
     currentRequestID = JSON.parse(event.data)["task_id"];
 
     switch (response_dict["status"]) {
@@ -121,10 +145,7 @@ ws.onmessage = function (event) {
     }
 };
 
-
-ws.onclose = function (event) {
-    console.log("WebSocket is closed now.");
-};
+connect();
 function sendMessage() {
     const prompt = document.getElementById('prompt').value;
     const max_new_tokens = document.getElementById('max_new_tokens').value;
@@ -171,6 +192,7 @@ function sendMessage() {
 
     document.getElementById('chat-output').insertBefore(userMessageContainer, document.getElementById('chat-output').firstChild);
     console.log (inserted_image);
+    generationSteps = 0;
     ws.send(JSON.stringify({
         "prompt": prompt,
         "reply_prefix": reply_prefix,
@@ -2,12 +2,24 @@
 
 import uuid
 from abc import abstractmethod
-from typing import AsyncGenerator, Dict, Generic, List, Optional, TypeVar, cast
+from typing import (
+    Any,
+    AsyncGenerator,
+    Dict,
+    Generic,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    cast,
+)
 
 from PIL import Image
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, model_validator
 from transformers import PreTrainedTokenizerBase
 
+from ..tracing import tracer
+
 
 class SamplingParams(BaseModel):
     """Sampling settings"""
@@ -15,6 +27,34 @@ class SamplingParams(BaseModel):
     max_new_tokens: int = 1000
     temperature: float = 0.6
     top_p: float = 0.95
+    n: int = Field(default=1, ge=1, description="Number of returned candidates")
+    best_of: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="Number of sampled candidates the best `n` are chosen from",
+    )
+
+    @model_validator(mode="after")
+    def check_best_of(self):
+        """Check that best_of is not less than n"""
+        if self.best_of is not None and self.best_of < self.n:
+            raise ValueError("best_of must be greater than or equal to n")
+        return self
+
+    @property
+    def num_candidates(self) -> int:
+        """Number of candidates to sample"""
+        return self.best_of or self.n
+
+
+def tag_candidate(index: int, text: str, n: int) -> str | Dict[str, Any]:
+    """
+    Tag a chunk of a candidate completion with its index.
+    Single completions are returned as is to keep the response format unchanged.
+    """
+    if n == 1:
+        return text
+    return {"index": index, "text": text}
 
 
 _SamplingParams_contra = TypeVar(
@@ -32,21 +72,37 @@ class PreparePromptMixin:
         messages: List[Dict[str, str]],
     ):
         """Prepare prompt for model"""
-        eot_uuid = "eot_" + str(uuid.uuid4())
-        prompt = (
-            cast(
-                str,
-                tokenizer.apply_chat_template(
-                    messages,
-                    tokenize=False,
-                    add_generation_prompt=False,
-                ),
-            ).rstrip()
-            + eot_uuid
+        with tracer.start_span("prepare_prompt", messages=len(messages)):
+            eot_uuid = "eot_" + str(uuid.uuid4())
+            prompt = (
+                cast(
+                    str,
+                    tokenizer.apply_chat_template(
+                        messages,
+                        tokenize=False,
+                        add_generation_prompt=False,
+                    ),
+                ).rstrip()
+                + eot_uuid
+            )
+            prompt = prompt.replace(tokenizer.eos_token + eot_uuid, "")
+            prompt = prompt.replace(eot_uuid, "")
+            return prompt
+
+    def prepare_system_prefix(
+        self,
+        tokenizer: PreTrainedTokenizerBase,
+        system_prompt: str,
+    ):
+        """Prepare the prompt prefix of a conversation starting with a system prompt"""
+        return cast(
+            str,
+            tokenizer.apply_chat_template(
+                [{"role": "system", "content": system_prompt}],
+                tokenize=False,
+                add_generation_prompt=False,
+            ),
         )
-        prompt = prompt.replace(tokenizer.eos_token + eot_uuid, "")
-        prompt = prompt.replace(eot_uuid, "")
-        return prompt
 
 
 # pylint: disable=too-few-public-methods
@@ -66,7 +122,7 @@ class Engine(Generic[_SamplingParams_contra], PreparePromptMixin):
         reply_prefix: str,
         image: Optional[Image.Image],
         sampling_params: _SamplingParams_contra,
-    ) -> AsyncGenerator[str, None]:
+    ) -> AsyncGenerator[str | Dict[str, Any], None]:
         if image:
             prompt = "<image>\n" + prompt if image else prompt
             self.image[conversation_id] = image
@@ -82,18 +138,19 @@ class Engine(Generic[_SamplingParams_contra], PreparePromptMixin):
         self.conversations[conversation_id].append({"role": "user", "content": prompt})
 
         reply: str = ""
-        async for response in self.generate(
+        async for index, response in self.generate(
             self.conversations[conversation_id],
-            self.image[conversation_id],
+            self.image.get(conversation_id),
             reply_prefix,
             sampling_params,
         ):
-            reply += response
-            yield response
+            if index == 0:
+                reply += response
+            yield tag_candidate(index, response, sampling_params.n)
         self.conversations[conversation_id].append(
             {"role": "assistant", "content": reply}
         )
-        yield ""
+        yield tag_candidate(0, "", sampling_params.n)
 
     @abstractmethod
     async def generate(
@@ -102,9 +159,16 @@ class Engine(Generic[_SamplingParams_contra], PreparePromptMixin):
         image: Optional[Image.Image],
         reply_prefix: str,
         sampling_params: _SamplingParams_contra,
-    ):
-        """Generate text from prompt"""
-        yield str()
+    ) -> AsyncGenerator[Tuple[int, str], None]:
+        """Generate text from prompt, yielding (candidate index, text) pairs"""
+        yield 0, str()
+
+    def metrics(self) -> Dict[str, Any]:
+        """Engine metrics"""
+        return {}
+
+    def close(self):
+        """Release engine resources"""
 
 
 # pylint: disable=too-few-public-methods
@@ -151,17 +215,18 @@ class ConcurrentEngine(Generic[_SamplingParams_contra], PreparePromptMixin):
             {"role": "assistant", "content": reply_prefix}
         )
         try:
-            async for response in self.generate(
+            async for index, response in self.generate(
                 self.conversations[conversation_id],
                 self.image[conversation_id],
                 reply_prefix,
                 sampling_params,
                 task_id,
             ):
-                self.conversations[conversation_id][-1]["content"] += response
-                yield response
+                if index == 0:
+                    self.conversations[conversation_id][-1]["content"] += response
+                yield tag_candidate(index, response, sampling_params.n)
         finally:
-            yield ""
+            yield tag_candidate(0, "", sampling_params.n)
 
     @abstractmethod
     # pylint: disable=too-many-positional-arguments
@@ -172,6 +237,13 @@ class ConcurrentEngine(Generic[_SamplingParams_contra], PreparePromptMixin):
         reply_prefix: str,
         sampling_params: _SamplingParams_contra,
         task_id: str,
-    ):
-        """Generate text from prompt"""
-        yield str()
+    ) -> AsyncGenerator[Tuple[int, str], None]:
+        """Generate text from prompt, yielding (candidate index, text) pairs"""
+        yield 0, str()
+
+    def metrics(self) -> Dict[str, Any]:
+        """Engine metrics"""
+        return {}
+
+    def close(self):
+        """Release engine resources"""
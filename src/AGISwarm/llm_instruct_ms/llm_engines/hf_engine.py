@@ -1,27 +1,24 @@
 """ LLM Instruct Model Inference """
 
-from threading import Thread
-from typing import Dict, List, cast
+import asyncio
+import copy
+import gc
+import logging
+import time
+from queue import Queue
+from threading import Event, Thread
+from typing import Any, Dict, List, Optional, Tuple, cast
 
 import torch
 import transformers  # type: ignore
 from PIL import Image
 from pydantic import Field
-from transformers import AutoTokenizer  # type: ignore
+from transformers import AutoTokenizer, DynamicCache  # type: ignore
+from transformers.generation.streamers import BaseStreamer  # type: ignore
 
+from ..tracing import tracer
 from .engine import Engine, SamplingParams
-
-MODEL_IS_4bit = {
-    "meta-llama/Meta-Llama-3-8B-Instruct": False,
-    "unsloth/llama-3-8b-Instruct-bnb-4bit": True,
-    "unsloth/llama-3-8b-Instruct": False,
-    "DevsDoCode/LLama-3-8b-Uncensored": False,
-    "DevsDoCode/LLama-3-8b-Uncensored-4bit": True,
-    "IlyaGusev/saiga_llama3_8b": False,
-    "RichardErkhov/IlyaGusev_-_saiga_llama3_8b-4bits": True,
-    "RLHFlow/LLaMA3-iterative-DPO-final": False,
-    "apple/OpenELM-1_1B-Instruct": False,
-}
+from .prefix_cache import PrefixCache
 
 BNB_CONFIG = transformers.BitsAndBytesConfig(
     load_in_4bit=True,
@@ -31,23 +28,134 @@ BNB_CONFIG = transformers.BitsAndBytesConfig(
 )
 
 
+def get_quantization_config(
+    hf_model_name: str, load_in_4bit: bool
+) -> transformers.BitsAndBytesConfig | None:
+    """
+    Get quantization config for loading the model.
+    Pre-quantized models are detected from their config.json and keep their own
+    quantization, other models are quantized with BNB_CONFIG if load_in_4bit is set.
+    """
+    model_config = transformers.AutoConfig.from_pretrained(hf_model_name)
+    quantization_config = getattr(model_config, "quantization_config", None)
+    if quantization_config is not None:
+        logging.info(
+            "Model is pre-quantized with %s", quantization_config.get("quant_method")
+        )
+        if load_in_4bit:
+            logging.warning("load_in_4bit ignored for a pre-quantized model")
+        return None
+    return BNB_CONFIG if load_in_4bit else None
+
+
+def get_torch_dtype(torch_dtype: str | None) -> torch.dtype | str | None:
+    """Get the torch dtype of the torch_dtype option, keeping None and "auto" as is"""
+    if torch_dtype in (None, "auto"):
+        return torch_dtype
+    dtype = getattr(torch, torch_dtype, None)
+    if not isinstance(dtype, torch.dtype):
+        raise ValueError(f"torch_dtype {torch_dtype!r} is not a torch dtype name")
+    return dtype
+
+
 class HFSamplingParams(SamplingParams):
     """HF sampling settings"""
 
     repetition_penalty: float = Field(default=1.2, description="Repetition penalty")
 
 
+class CandidateStreamer(BaseStreamer):
+    """
+    Streams the text of every returned sequence tagged with its index.
+    Every sequence is decoded incrementally over a window of its unsent tokens
+    and of the tokens sent last, which give the context of the leading space.
+    """
+
+    def __init__(self, tokenizer: transformers.PreTrainedTokenizerBase):
+        self.tokenizer = tokenizer
+        self.windows: List[List[int]] = []
+        self.sent_len: List[int] = []
+        self.text_queue: Queue[Tuple[int, str] | None] = Queue()
+        self.prompt_skipped = False
+
+    def decode(self, token_ids: List[int]) -> str:
+        """Decode the tokens"""
+        return self.tokenizer.decode(
+            token_ids,
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=True,
+        )
+
+    def put(self, value: torch.Tensor):
+        """Receive the next token of every sequence"""
+        if not self.prompt_skipped:
+            self.prompt_skipped = True
+            return
+        for index, token_id in enumerate(value.reshape(-1).tolist()):
+            if index == len(self.windows):
+                self.windows.append([])
+                self.sent_len.append(0)
+            window = self.windows[index]
+            window.append(token_id)
+            sent_text = self.decode(window[: self.sent_len[index]])
+            text = self.decode(window)
+            # Wait for the rest of an incomplete multibyte character
+            if text.endswith("\ufffd") or len(text) <= len(sent_text):
+                continue
+            self.text_queue.put((index, text[len(sent_text) :]))
+            # The sent tokens become the context of the next window
+            self.windows[index] = window[self.sent_len[index] :]
+            self.sent_len[index] = len(self.windows[index])
+
+    def end(self):
+        """Signal the end of generation"""
+        self.text_queue.put(None)
+
+    def __iter__(self):
+        while (item := self.text_queue.get()) is not None:
+            yield item
+
+
 # pylint: disable=too-few-public-methods
+class StopEventCriteria(transformers.StoppingCriteria):
+    """Stops generation once the event is set, e.g. when the request is aborted"""
+
+    def __init__(self, stop_event: Event):
+        self.stop_event = stop_event
+
+    def __call__(self, input_ids: torch.Tensor, scores: torch.Tensor, **kwargs):
+        return torch.full(
+            (input_ids.shape[0],),
+            self.stop_event.is_set(),
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
+
+
+# pylint: disable=too-few-public-methods, too-many-instance-attributes
 class HFEngine(Engine[HFSamplingParams]):  # pylint: disable=invalid-name
     """LLM Instruct Model Inference"""
 
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
     def __init__(
         self,
         hf_model_name: str,
         tokenizer_name: str | None,
+        pinned_system_prompts: List[str] | None = None,
+        torch_dtype: str | None = None,
+        attn_implementation: str | None = None,
+        load_in_4bit: bool = False,
+        torch_compile: bool = False,
+        cache_implementation: str | None = None,
     ):
 
+        if torch_compile and cache_implementation != "static":
+            # A dynamic cache changes shapes every step and keeps recompiling
+            logging.warning("torch_compile needs a static KV cache, using it")
+            cache_implementation = "static"
         self.conversations: Dict[str, List[Dict]] = {}
+        self.image: Dict[str, Image.Image | None] = {}
+        self.image_prompt_enabled = False
         self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name or hf_model_name)
 
         self.pipeline = cast(
@@ -58,12 +166,159 @@ class HFEngine(Engine[HFSamplingParams]):  # pylint: disable=invalid-name
                 device_map="auto",
                 tokenizer=self.tokenizer,
                 model_kwargs={
-                    "quantization_config": (
-                        BNB_CONFIG if MODEL_IS_4bit[hf_model_name] else None
-                    )
+                    "quantization_config": get_quantization_config(
+                        hf_model_name, load_in_4bit
+                    ),
+                    "torch_dtype": get_torch_dtype(torch_dtype),
+                    "attn_implementation": attn_implementation,
                 },
             ),
         )
+        self.cache_implementation = cache_implementation
+        self.threads: List[Thread] = []
+        self.pad_token_id = (
+            self.tokenizer.pad_token_id
+            if self.tokenizer.pad_token_id is not None
+            else self.tokenizer.eos_token_id
+        )
+        if torch_compile:
+            self.pipeline.model.forward = torch.compile(
+                self.pipeline.model.forward, mode="reduce-overhead", fullgraph=True
+            )
+        self.prefix_cache: PrefixCache[DynamicCache] = PrefixCache()
+        if cache_implementation is not None and pinned_system_prompts:
+            logging.warning(
+                "Pinned system prompts ignored with %s KV cache", cache_implementation
+            )
+        elif pinned_system_prompts:
+            for system_prompt in pinned_system_prompts:
+                self.pin_system_prompt(system_prompt)
+
+    @torch.no_grad()
+    def pin_system_prompt(self, system_prompt: str):
+        """Precompute and pin the KV cache of a system prompt"""
+        prefix = self.prepare_system_prefix(self.tokenizer, system_prompt)
+        input_ids = cast(
+            torch.Tensor,
+            self.tokenizer(
+                prefix, return_tensors="pt", add_special_tokens=False
+            ).input_ids,
+        ).to(self.pipeline.model.device)
+        cache = DynamicCache()
+        self.pipeline.model(input_ids=input_ids, past_key_values=cache, use_cache=True)
+        self.prefix_cache.pin(input_ids[0].tolist(), cache)
+        logging.info("Pinned system prompt prefix of %d tokens", input_ids.shape[1])
+
+    @torch.no_grad()
+    def prefill(
+        self,
+        input_ids: torch.Tensor,
+        num_candidates: int,
+        prefix: Optional[Tuple[int, DynamicCache]] = None,
+    ) -> DynamicCache:
+        """
+        Prefill the prompt once and share its KV cache between all candidates.
+        Prefilling starts after the pinned prefix, if any.
+        The last prompt token is left to `generate` to get the first logits.
+        """
+        start, cache = (
+            (prefix[0], copy.deepcopy(prefix[1])) if prefix else (0, DynamicCache())
+        )
+        if start < input_ids.shape[1] - 1:
+            self.pipeline.model(
+                input_ids=input_ids[:, start:-1],
+                past_key_values=cache,
+                use_cache=True,
+            )
+        if num_candidates > 1:
+            cache.batch_repeat_interleave(num_candidates)
+        return cache
+
+    def metrics(self) -> Dict[str, Any]:
+        """Prefix cache metrics"""
+        return {"prefix_cache": self.prefix_cache.metrics()}
+
+    def close(self):
+        """Release the model and its GPU memory"""
+        # Stopped generation threads finish their current step
+        for thread in self.threads:
+            thread.join()
+        self.prefix_cache.entries.clear()
+        del self.pipeline
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    def get_generate_kwargs(
+        self, input_ids: torch.Tensor, sampling_params: HFSamplingParams
+    ) -> Dict[str, Any]:
+        """Get model.generate kwargs, without the cache of the prompt"""
+        generate_kwargs = {
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+            "do_sample": True,
+            "num_return_sequences": sampling_params.num_candidates,
+            "pad_token_id": self.pad_token_id,
+        } | sampling_params.model_dump(exclude={"n", "best_of"})
+        if self.cache_implementation is not None:
+            generate_kwargs["cache_implementation"] = self.cache_implementation
+        return generate_kwargs
+
+    async def generate_ranked(
+        self, generate_kwargs: Dict[str, Any], n: int
+    ) -> List[str]:
+        """Generate all candidates and return the best n by log-probability"""
+        stop_event = Event()
+        try:
+            outputs = await asyncio.to_thread(
+                self.pipeline.model.generate,
+                **generate_kwargs,
+                # Generation stops once the consumer of generate is gone
+                stopping_criteria=transformers.StoppingCriteriaList(
+                    [StopEventCriteria(stop_event)]
+                ),
+                return_dict_in_generate=True,
+                output_scores=True,
+            )
+        finally:
+            stop_event.set()
+        generated = outputs.sequences[:, generate_kwargs["input_ids"].shape[1] :]
+        scores = self.pipeline.model.compute_transition_scores(
+            outputs.sequences, outputs.scores, normalize_logits=True
+        ).masked_fill(generated == self.pad_token_id, 0.0)
+        return [
+            cast(
+                str,
+                self.tokenizer.decode(
+                    generated[row],
+                    skip_special_tokens=True,
+                    clean_up_tokenization_spaces=True,
+                ),
+            )
+            for row in scores.sum(dim=1).argsort(descending=True)[:n].tolist()
+        ]
+
+    def stream_candidates(self, generate_kwargs: Dict[str, Any]):
+        """Stream the candidates generated in a thread"""
+        stop_event = Event()
+        streamer = CandidateStreamer(self.tokenizer)
+        thread = Thread(
+            target=self.pipeline.model.generate,
+            kwargs=generate_kwargs
+            | {
+                "streamer": streamer,
+                # The thread stops once the consumer of generate is gone
+                "stopping_criteria": transformers.StoppingCriteriaList(
+                    [StopEventCriteria(stop_event)]
+                ),
+            },
+        )
+        thread.start()
+        self.threads = [thread for thread in self.threads if thread.is_alive()]
+        self.threads.append(thread)
+        try:
+            yield from streamer
+        finally:
+            stop_event.set()
 
     async def generate(
         self,
@@ -75,22 +330,56 @@ class HFEngine(Engine[HFSamplingParams]):  # pylint: disable=invalid-name
         """Generate text from prompt"""
         if image:
             raise NotImplementedError("Image input not supported")
-        streamer = transformers.TextIteratorStreamer(
-            self.tokenizer, skip_prompt=True, skip_special_tokens=True  # type: ignore
-        )
-        prompt = self.prepare_prompt(self.tokenizer, messages)
-        thread = Thread(
-            target=self.pipeline,
-            kwargs={
-                "text_inputs": prompt,
-                "do_sample": True,
-                "streamer": streamer,
-                "clean_up_tokenization_spaces": True,
-            }
-            | sampling_params.model_dump(),
+        start_time = time.perf_counter()
+        input_ids = cast(
+            torch.Tensor,
+            self.tokenizer(
+                self.prepare_prompt(self.tokenizer, messages),
+                return_tensors="pt",
+                add_special_tokens=False,
+            ).input_ids,
+        ).to(self.pipeline.model.device)
+        generate_kwargs = self.get_generate_kwargs(input_ids, sampling_params)
+        prefix = self.prefix_cache.lookup(input_ids[0].tolist())
+        prefill_span = tracer.start_span(
+            "prefill",
+            prompt_tokens=input_ids.shape[1],
+            prefix_cache_hit=prefix is not None,
         )
-        thread.start()
-        if reply_prefix:
-            yield reply_prefix
-        for new_text in streamer:
-            yield cast(str, new_text)
+        # The shared prefill fills a DynamicCache, so it is skipped for other caches
+        if self.cache_implementation is None and (
+            prefix or sampling_params.num_candidates > 1
+        ):
+            generate_kwargs["past_key_values"] = self.prefill(
+                input_ids, sampling_params.num_candidates, prefix
+            )
+        if sampling_params.num_candidates > sampling_params.n:
+            prefill_span.end()
+            # Candidates are ranked by their log-probability once finished.
+            # The first token is not observed, so no time to first token is recorded.
+            with tracer.start_span("decode", candidates=sampling_params.num_candidates):
+                texts = await self.generate_ranked(generate_kwargs, sampling_params.n)
+            for index, text in enumerate(texts):
+                yield index, reply_prefix + text
+            return
+        candidates = self.stream_candidates(generate_kwargs)
+        decode_span = None
+        try:
+            if reply_prefix:
+                for index in range(sampling_params.n):
+                    yield index, reply_prefix
+            for index, text in candidates:
+                if decode_span is None:
+                    prefill_span.end()
+                    self.prefix_cache.record_ttft(
+                        prefix is not None, time.perf_counter() - start_time
+                    )
+                    decode_span = tracer.start_span(
+                        "decode", candidates=sampling_params.num_candidates
+                    )
+                yield index, text
+        finally:
+            candidates.close()
+            prefill_span.end()
+            if decode_span is not None:
+                decode_span.end()
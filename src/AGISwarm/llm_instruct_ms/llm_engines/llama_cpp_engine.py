@@ -1,13 +1,18 @@
 """LLaMA C++ Engine"""
 
-from typing import Dict, List, cast
+import logging
+import secrets
+import time
+from typing import Any, Dict, List, cast
 
-from llama_cpp import CreateCompletionStreamResponse, Llama
+from llama_cpp import CreateCompletionStreamResponse, Llama, LlamaState
 from PIL import Image
 from pydantic import Field
 from transformers import PreTrainedTokenizer
 
+from ..tracing import tracer
 from .engine import Engine, SamplingParams
+from .prefix_cache import PrefixCache
 
 
 class LlamaCppSamplingParams(SamplingParams):
@@ -29,6 +34,7 @@ class LlamaCppEngine(Engine[LlamaCppSamplingParams]):
         filename: str,
         n_gpu_layers: int = -1,
         n_ctx: int = 8192,
+        pinned_system_prompts: List[str] | None = None,
     ):
         self.llama = Llama.from_pretrained(
             hf_model_name, filename=filename, n_gpu_layers=n_gpu_layers, n_ctx=n_ctx
@@ -37,6 +43,29 @@ class LlamaCppEngine(Engine[LlamaCppSamplingParams]):
             tokenizer_name or hf_model_name
         )
         self.conversations: Dict[str, List[Dict]] = {}
+        self.image: Dict[str, Image.Image | None] = {}
+        self.image_prompt_enabled = False
+        self.prefix_cache: PrefixCache[LlamaState] = PrefixCache()
+        for system_prompt in pinned_system_prompts or []:
+            self.pin_system_prompt(system_prompt)
+
+    def pin_system_prompt(self, system_prompt: str):
+        """Precompute and pin the KV state of a system prompt"""
+        prefix = self.prepare_system_prefix(self.tokenizer, system_prompt)
+        tokens = self.llama.tokenize(prefix.encode("utf-8"), special=True)
+        self.llama.reset()
+        self.llama.eval(tokens)
+        self.prefix_cache.pin(tokens, self.llama.save_state())
+        logging.info("Pinned system prompt prefix of %d tokens", len(tokens))
+
+    def metrics(self) -> Dict[str, Any]:
+        """Prefix cache metrics"""
+        return {"prefix_cache": self.prefix_cache.metrics()}
+
+    def close(self):
+        """Release the model"""
+        self.prefix_cache.entries.clear()
+        self.llama.close()
 
     def get_sampling_params(self, sampling_params: LlamaCppSamplingParams):
         """Get sampling params"""
@@ -45,6 +74,8 @@ class LlamaCppEngine(Engine[LlamaCppSamplingParams]):
         sampling_params_dict["repeat_penalty"] = sampling_params_dict.pop(
             "repetition_penalty"
         )
+        sampling_params_dict.pop("n")
+        sampling_params_dict.pop("best_of")
         return sampling_params_dict
 
     async def generate(
@@ -57,14 +88,54 @@ class LlamaCppEngine(Engine[LlamaCppSamplingParams]):
         """Generate text from prompt"""
         if image:
             raise NotImplementedError("Image input not supported")
+        if sampling_params.num_candidates > sampling_params.n:
+            raise NotImplementedError("best_of > n not supported")
+        start_time = time.perf_counter()
         prompt = self.prepare_prompt(self.tokenizer, messages)
-        sampling_params_dict = self.get_sampling_params(sampling_params)
-        if reply_prefix:
-            yield reply_prefix
-        for output in self.llama(
-            prompt,
-            **sampling_params_dict,
-            stream=True,
+        # Llama rewinds its KV cache to the longest common prefix of the
+        # evaluated tokens, so every candidate after the first one forks
+        # from the already prefilled prompt instead of evaluating it again.
+        prompt_tokens = self.llama.tokenize(prompt.encode("utf-8"), special=True)
+        prefix = self.prefix_cache.lookup(prompt_tokens)
+        prefix_cache_hit = prefix is not None
+        prefill_span = tracer.start_span(
+            "prefill",
+            prompt_tokens=len(prompt_tokens),
+            prefix_cache_hit=prefix_cache_hit,
+        )
+        # Restore the pinned prefix unless the live KV cache already shares it
+        if prefix and (
+            Llama.longest_token_prefix(
+                self.llama.input_ids[: self.llama.n_tokens], prompt_tokens
+            )
+            < prefix[0]
         ):
-            output = cast(CreateCompletionStreamResponse, output)
-            yield output["choices"][0]["text"]
+            self.llama.load_state(prefix[1])
+        decode_span = None
+        sampling_params_dict = self.get_sampling_params(sampling_params)
+        try:
+            for index in range(sampling_params.n):
+                if reply_prefix:
+                    yield index, reply_prefix
+                # The sampler is seeded on every call, so every candidate
+                # needs its own seed to differ from the others
+                for output in self.llama(
+                    prompt_tokens,
+                    **sampling_params_dict,
+                    seed=secrets.randbits(32),
+                    stream=True,
+                ):
+                    output = cast(CreateCompletionStreamResponse, output)
+                    if decode_span is None:
+                        prefill_span.end()
+                        self.prefix_cache.record_ttft(
+                            prefix_cache_hit, time.perf_counter() - start_time
+                        )
+                        decode_span = tracer.start_span(
+                            "decode", candidates=sampling_params.n
+                        )
+                    yield index, output["choices"][0]["text"]
+        finally:
+            prefill_span.end()
+            if decode_span is not None:
+                decode_span.end()
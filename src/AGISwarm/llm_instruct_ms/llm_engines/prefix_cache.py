@@ -0,0 +1,67 @@
+"""Prefix cache for pinned system prompts"""
+
+from typing import Dict, Generic, List, Optional, Sequence, Tuple, TypeVar
+
+_State = TypeVar("_State")
+
+
+class PrefixCache(Generic[_State]):
+    """
+    Cache of precomputed KV states for prompt prefixes pinned at startup.
+    Keeps hit-rate and time-to-first-token metrics.
+    """
+
+    def __init__(self):
+        self.entries: List[Tuple[Tuple[int, ...], _State]] = []
+        self.hits = 0
+        self.misses = 0
+        self.ttft_total: Dict[str, float] = {"hit": 0.0, "miss": 0.0}
+        self.ttft_count: Dict[str, int] = {"hit": 0, "miss": 0}
+
+    def pin(self, tokens: Sequence[int], state: _State):
+        """Pin the KV state of a prefix"""
+        self.entries.append((tuple(tokens), state))
+
+    def lookup(self, tokens: Sequence[int]) -> Optional[Tuple[int, _State]]:
+        """
+        Find the longest pinned prefix of the tokens.
+        At least one token is left to compute the logits of the next token.
+        :return: the prefix length and its KV state, or None on miss
+        """
+        if not self.entries:
+            return None
+        best: Optional[Tuple[int, _State]] = None
+        best_len = 0
+        for prefix, state in self.entries:
+            if (
+                best_len < len(prefix) < len(tokens)
+                and tuple(tokens[: len(prefix)]) == prefix
+            ):
+                best = (len(prefix), state)
+                best_len = len(prefix)
+        if best is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return best
+
+    def record_ttft(self, hit: bool, seconds: float):
+        """Record the time to first token of a request"""
+        key = "hit" if hit else "miss"
+        self.ttft_total[key] += seconds
+        self.ttft_count[key] += 1
+
+    def metrics(self) -> Dict[str, bool | float | int | None]:
+        """Hit-rate and mean time-to-first-token metrics"""
+        lookups = self.hits + self.misses
+        metrics: Dict[str, bool | float | int | None] = {
+            "enabled": bool(self.entries),
+            "pinned_prefixes": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
+        for key, total in self.ttft_total.items():
+            count = self.ttft_count[key]
+            metrics[f"ttft_{key}_mean"] = total / count if count else None
+        return metrics
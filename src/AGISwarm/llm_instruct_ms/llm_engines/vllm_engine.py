@@ -1,14 +1,18 @@
 """ LLM Instruct Model Inference """
 
 import asyncio
+import gc
 import logging
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
+import torch
 import vllm  # type: ignore
 from huggingface_hub import hf_hub_download
 from PIL import Image
 from pydantic import Field
+from vllm.utils import Device  # type: ignore
 
+from ..tracing import tracer
 from .engine import ConcurrentEngine, SamplingParams
 
 
@@ -20,6 +24,7 @@ class VLLMSamplingParams(SamplingParams):
     presence_penalty: float = Field(default=0.0, description="Presence penalty")
 
 
+# pylint: disable=too-many-instance-attributes
 class VLLMEngine(ConcurrentEngine[VLLMSamplingParams]):
     """LLM Instruct Model Inference using VLLM"""
 
@@ -28,6 +33,7 @@ class VLLMEngine(ConcurrentEngine[VLLMSamplingParams]):
         hf_model_name: str,
         filename: str | None = None,
         tokenizer_name: str | None = None,
+        enable_prefix_caching: bool = False,
         **kwargs,
     ):
         if filename is not None:
@@ -41,6 +47,7 @@ class VLLMEngine(ConcurrentEngine[VLLMSamplingParams]):
                 model=model,
                 tokenizer=tokenizer_name or hf_model_name,
                 trust_remote_code=True,
+                enable_prefix_caching=enable_prefix_caching,
                 **kwargs,
             )
         )
@@ -57,6 +64,33 @@ class VLLMEngine(ConcurrentEngine[VLLMSamplingParams]):
                 and mm_cfg.limit_per_prompt["image"] > 0
             )
         self.tokenizer = asyncio.run(self.model.get_tokenizer())
+        self.enable_prefix_caching = enable_prefix_caching
+        self.ttft_total = 0.0
+        self.ttft_count = 0
+
+    def metrics(self) -> Dict[str, Any]:
+        """Prefix cache metrics"""
+        hit_rate = (
+            self.model.engine.scheduler[0].get_prefix_cache_hit_rate(Device.GPU)
+            if self.enable_prefix_caching
+            else None
+        )
+        return {
+            "prefix_cache": {
+                "enabled": self.enable_prefix_caching,
+                "hit_rate": hit_rate,
+                "ttft_mean": (
+                    self.ttft_total / self.ttft_count if self.ttft_count else None
+                ),
+            }
+        }
+
+    def close(self):
+        """Shut the engine down and release its GPU memory"""
+        self.model.shutdown_background_loop()
+        del self.model
+        gc.collect()
+        torch.cuda.empty_cache()
 
     def get_sampling_params(
         self, sampling_params: VLLMSamplingParams
@@ -70,6 +104,27 @@ class VLLMEngine(ConcurrentEngine[VLLMSamplingParams]):
             truncate_prompt_tokens=True,
         )
 
+    @staticmethod
+    def new_text(
+        output: vllm.RequestOutput, current_len: Dict[int, int]
+    ) -> List[Tuple[int, str]]:
+        """Get the text of every candidate generated since its previous output"""
+        new_text = []
+        for completion in output.outputs:
+            start = current_len.get(completion.index, 0)
+            if len(completion.text) > start:
+                new_text.append((completion.index, completion.text[start:]))
+            current_len[completion.index] = len(completion.text)
+        return new_text
+
+    def record_ttft(self, output: vllm.RequestOutput):
+        """Record the time to first token of a finished request"""
+        if output.metrics and output.metrics.first_token_time:
+            self.ttft_total += (
+                output.metrics.first_token_time - output.metrics.arrival_time
+            )
+            self.ttft_count += 1
+
     # pylint: disable=too-many-arguments, too-many-positional-arguments
     async def generate(
         self,
@@ -83,22 +138,44 @@ class VLLMEngine(ConcurrentEngine[VLLMSamplingParams]):
         if image and not self.image_prompt_enabled:
             logging.warning("Image input not supported by this model")
         prompt = self.prepare_prompt(self.tokenizer, messages)  # type: ignore
-        vllm_sampling_params = self.get_sampling_params(sampling_params)
-        current_len = 0
+        # best_of > n candidates are ranked once finished, so they are not streamed
+        stream = sampling_params.num_candidates == sampling_params.n
+        current_len: Dict[int, int] = {}
         if reply_prefix:
-            yield reply_prefix
-        async for output in self.model.generate(
-            (
-                vllm.TextPrompt(
-                    {"prompt": prompt, "multi_modal_data": {"image": image}}
-                )
-                if image and self.image_prompt_enabled
-                else prompt
-            ),
-            sampling_params=vllm_sampling_params,
-            request_id=task_id,
-        ):
-            yield output.outputs[0].text[current_len:]
-            current_len = len(output.outputs[0].text)
-            if output.finished:
-                break
+            for index in range(sampling_params.n):
+                yield index, reply_prefix
+        prefill_span = tracer.start_span("prefill")
+        decode_span = None
+        try:
+            async for output in self.model.generate(
+                (
+                    vllm.TextPrompt(
+                        {"prompt": prompt, "multi_modal_data": {"image": image}}
+                    )
+                    if image and self.image_prompt_enabled
+                    else prompt
+                ),
+                sampling_params=self.get_sampling_params(sampling_params),
+                request_id=task_id,
+            ):
+                if decode_span is None:
+                    prefill_span.set_attribute(
+                        "prompt_tokens", len(output.prompt_token_ids or [])
+                    )
+                    prefill_span.end()
+                    decode_span = tracer.start_span(
+                        "decode", candidates=sampling_params.num_candidates
+                    )
+                if stream:
+                    for index, text in self.new_text(output, current_len):
+                        yield index, text
+                if output.finished:
+                    self.record_ttft(output)
+                    if not stream:
+                        for index, completion in enumerate(output.outputs):
+                            yield index, completion.text
+                    break
+        finally:
+            prefill_span.end()
+            if decode_span is not None:
+                decode_span.end()
@@ -0,0 +1,50 @@
+"""On-demand profiling for a bounded time window"""
+
+import asyncio
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+
+def sample_stacks(seconds: float, interval: float = 0.005) -> str:
+    """
+    Sample the stacks of all threads, py-spy style.
+    :return: the samples in the collapsed stack format used by flamegraph tools
+    """
+    samples: Counter[str] = Counter()
+    current_thread_id = threading.get_ident()
+    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frames = sys._current_frames()  # pylint: disable=protected-access
+        for thread_id, frame in frames.items():
+            if thread_id == current_thread_id:
+                continue
+            stack = ";".join(
+                f"{summary.name} ({summary.filename}:{summary.lineno})"
+                for summary in traceback.extract_stack(frame)
+            )
+            samples[f"{thread_names.get(thread_id, thread_id)};{stack}"] += 1
+        time.sleep(interval)
+    return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+
+
+async def cprofile_event_loop(seconds: float) -> str:
+    """
+    Profile the event loop thread with cProfile.
+    :return: the statistics sorted by cumulative time
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(100)
+    return stream.getvalue()
@@ -0,0 +1,88 @@
+"""Conversation sessions that survive websocket reconnects"""
+
+import asyncio
+import secrets
+import time
+import uuid
+from typing import Any, AsyncGenerator, Dict, List, Optional
+
+
+class Generation:
+    """Buffered steps of a generation, replayable by reattached clients"""
+
+    def __init__(self):
+        self.steps: List[Dict[str, Any]] = []
+        self.finished = False
+        self.updated = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def publish(self, step_info: Dict[str, Any]):
+        """Buffer the step and wake up the clients"""
+        self.steps.append(step_info)
+        self.updated.set()
+
+    def finish(self):
+        """Mark the generation as finished"""
+        self.finished = True
+        self.updated.set()
+
+    async def stream(self, offset: int = 0) -> AsyncGenerator[Dict[str, Any], None]:
+        """Stream the buffered steps from offset, then the new ones until finished"""
+        index = offset
+        while True:
+            while index < len(self.steps):
+                yield self.steps[index]
+                index += 1
+            if self.finished:
+                return
+            self.updated.clear()
+            await self.updated.wait()
+
+
+class Session:  # pylint: disable=too-few-public-methods
+    """Conversation owned by a session token"""
+
+    def __init__(self):
+        self.token = secrets.token_urlsafe(32)
+        self.conversation_id = str(uuid.uuid4())
+        self.generation: Optional[Generation] = None
+        self.connections = 0
+        self.expires_at: Optional[float] = None
+
+
+class SessionManager:
+    """Keeps detached sessions for a TTL so that clients can reattach"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.sessions: Dict[str, Session] = {}
+
+    def attach(self, token: Optional[str]) -> Session:
+        """Reattach to the session of the token, or start a new one"""
+        session = self.sessions.get(token) if token else None
+        if session is None or (
+            session.expires_at is not None and session.expires_at < time.monotonic()
+        ):
+            session = Session()
+            self.sessions[session.token] = session
+        session.connections += 1
+        session.expires_at = None
+        return session
+
+    def detach(self, session: Session):
+        """Detach a client, the session expires after the TTL without clients"""
+        session.connections -= 1
+        if session.connections == 0:
+            session.expires_at = time.monotonic() + self.ttl
+
+    def pop_expired(self) -> List[Session]:
+        """Remove and return the expired sessions"""
+        now = time.monotonic()
+        expired = [
+            session
+            for session in self.sessions.values()
+            if session.expires_at is not None and session.expires_at < now
+        ]
+        for session in expired:
+            del self.sessions[session.token]
+        return expired
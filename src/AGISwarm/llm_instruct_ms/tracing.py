@@ -0,0 +1,163 @@
+"""
+Per-request tracing.
+Spans are exported to a local file in the OTLP JSON format, one
+ExportTraceServiceRequest per line, as written by the OpenTelemetry
+Collector file exporter. Tracing is a no-op until a file is configured.
+"""
+
+import json
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import IO, Any, Dict, Optional
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+def _attribute_value(value: Any) -> Dict[str, Any]:
+    """Convert attribute value to OTLP AnyValue"""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Span:  # pylint: disable=too-many-instance-attributes
+    """Timed operation within a request trace"""
+
+    def __init__(
+        self,
+        owner: "Tracer",
+        name: str,
+        parent: Optional["Span"],
+        attributes: Dict[str, Any],
+    ):
+        self.owner = owner
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent.span_id if parent else ""
+        self.attributes = attributes
+        self.start_time = time.time_ns()
+        self.end_time: Optional[int] = None
+        self.token = None
+
+    def set_attribute(self, key: str, value: Any):
+        """Set span attribute"""
+        self.attributes[key] = value
+
+    def end(self):
+        """End the span and export it"""
+        if self.end_time is None:
+            self.end_time = time.time_ns()
+            self.owner.export(self)
+
+    def __enter__(self):
+        self.token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.set_attribute("exception.type", exc_type.__name__)
+        _current_span.reset(self.token)  # type: ignore
+        self.end()
+
+    def to_otlp(self) -> Dict[str, Any]:
+        """Convert span to OTLP JSON"""
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_time),
+            "endTimeUnixNano": str(self.end_time),
+            "attributes": [
+                {"key": key, "value": _attribute_value(value)}
+                for key, value in self.attributes.items()
+            ],
+        }
+
+
+class NoopSpan:
+    """Span returned when tracing is disabled"""
+
+    def set_attribute(self, key: str, value: Any):
+        """Set span attribute"""
+
+    def end(self):
+        """End the span"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Tracer:
+    """Creates spans and exports them to a local file"""
+
+    def __init__(self, service_name: str = "llm_instruct_ms"):
+        self.service_name = service_name
+        self.file: Optional[IO[str]] = None
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether spans are recorded"""
+        return self.file is not None
+
+    def configure(self, file: Optional[str]):
+        """Export spans to the file, or disable tracing if None"""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            # pylint: disable=consider-using-with
+            self.file = open(file, "a", encoding="utf-8") if file else None
+
+    def start_span(self, name: str, **attributes: Any) -> Span | NoopSpan:
+        """
+        Start a child of the current span.
+        Use it as a context manager to make it the current span.
+        """
+        if self.file is None:
+            return NOOP_SPAN
+        return Span(self, name, _current_span.get(), attributes)
+
+    def export(self, span: Span):
+        """Write the span to the file"""
+        request = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": self.service_name},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "AGISwarm.llm_instruct_ms"},
+                            "spans": [span.to_otlp()],
+                        }
+                    ],
+                }
+            ]
+        }
+        with self.lock:
+            if self.file is not None:
+                self.file.write(json.dumps(request) + "\n")
+                self.file.flush()
+
+
+tracer = Tracer()
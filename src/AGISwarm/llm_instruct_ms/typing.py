@@ -1,6 +1,6 @@
 """Application settings"""
 
-from typing import Dict, Literal, Optional, Type, Union
+from typing import Dict, List, Literal, Optional, Type, Union
 
 from omegaconf import DictConfig
 from uvicorn.config import LoopSetupType
@@ -37,11 +37,19 @@ class VLLMConfig(ModelConfig):
     """VLLM settings"""
 
     filename: str | None = None
+    enable_prefix_caching: bool = False
 
 
 class HFConfig(ModelConfig):
     """HF settings"""
 
+    pinned_system_prompts: List[str] = []
+    torch_dtype: str | None = None
+    attn_implementation: str | None = None
+    load_in_4bit: bool = False
+    torch_compile: bool = False
+    cache_implementation: str | None = None
+
 
 class LlamaCppConfig(ModelConfig):
     """LlamaCpp settings"""
@@ -49,6 +57,7 @@ class LlamaCppConfig(ModelConfig):
     filename: str = "*F16.gguf"
     n_gpu_layers: int = -1
     n_ctx: int = 8192
+    pinned_system_prompts: List[str] = []
 
 
 ENGINE_CONFIG_MAP: Dict[str, Type] = {
@@ -72,6 +81,8 @@ class SamplingConfig(DictConfig):
     repetition_penalty: float = 1.2
     frequency_penalty: float = 0.0
     presence_penalty: float = 0.0
+    n: int = 1
+    best_of: Optional[int] = None
 
 
 class UvicornConfig(DictConfig):
@@ -85,6 +96,26 @@ class UvicornConfig(DictConfig):
     loop: LoopSetupType
 
 
+class TracingConfig(DictConfig):
+    """Tracing settings"""
+
+    enabled: bool = False
+    file: str = "traces.jsonl"
+
+
+class SessionConfig(DictConfig):
+    """Session settings"""
+
+    ttl: float = 600.0
+    sweep_interval: float = 10.0
+
+
+class AdminConfig(DictConfig):
+    """Admin endpoint settings"""
+
+    token: str | None = None
+
+
 class GUIConfig(DictConfig):
     """GUI settings"""
 
@@ -100,4 +131,7 @@ class LLMInstructConfig(DictConfig):
     engine_config: Optional[Union[HFConfig, VLLMConfig, LlamaCppConfig]]
     gui_config: GUIConfig
     uvicorn_config: UvicornConfig
+    tracing_config: TracingConfig
+    session_config: SessionConfig
+    admin_config: AdminConfig
     sampling_settings: SamplingConfig
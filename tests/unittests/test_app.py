@@ -0,0 +1,192 @@
+"""Tests of the engine reload"""
+
+# pylint: disable=import-error
+import asyncio
+import types
+
+import pytest  # type: ignore
+
+app = pytest.importorskip("AGISwarm.llm_instruct_ms.app")
+omegaconf = pytest.importorskip("omegaconf")
+
+LLMInstructApp = app.LLMInstructApp
+
+
+def make_config():
+    """Config of the running engine"""
+    return omegaconf.OmegaConf.create(
+        {
+            "hf_model_name": "old/model",
+            "tokenizer_name": "old/tokenizer",
+            "engine": "HFEngine",
+            "engine_config": {"load_in_4bit": True},
+        }
+    )
+
+
+def test_reload_config_keeps_unset_fields():
+    """Unset fields of the reload request are taken from the current config"""
+    config = make_config()
+    request = LLMInstructApp.ReloadRequest(engine_config={"torch_compile": True})
+    new_config = LLMInstructApp.reload_config(config, request)
+    assert new_config.hf_model_name == "old/model"
+    assert new_config.tokenizer_name == "old/tokenizer"
+    assert dict(new_config.engine_config) == {"torch_compile": True}
+    assert dict(config.engine_config) == {"load_in_4bit": True}
+
+
+def test_reload_config_resets_tokenizer_of_another_model():
+    """A new model without a tokenizer name loads its own tokenizer"""
+    config = make_config()
+    request = LLMInstructApp.ReloadRequest(hf_model_name="new/model")
+    new_config = LLMInstructApp.reload_config(config, request)
+    assert new_config.hf_model_name == "new/model"
+    assert new_config.tokenizer_name is None
+    assert config.tokenizer_name == "old/tokenizer"
+
+    request = LLMInstructApp.ReloadRequest(
+        hf_model_name="new/model", tokenizer_name="new/tokenizer"
+    )
+    new_config = LLMInstructApp.reload_config(config, request)
+    assert new_config.tokenizer_name == "new/tokenizer"
+
+
+def test_reload_config_resets_engine_config_of_another_engine():
+    """Engine kwargs are dropped when the engine class changes"""
+    config = make_config()
+    request = LLMInstructApp.ReloadRequest(engine="VLLMEngine")
+    new_config = LLMInstructApp.reload_config(config, request)
+    assert new_config.engine == "VLLMEngine"
+    assert new_config.engine_config is None
+
+
+class FakeQueueManager:  # pylint: disable=too-few-public-methods
+    """Queue manager whose aborted tasks leave the in-flight map"""
+
+    def __init__(self, inflight):
+        self.inflight = inflight
+        self.aborted = []
+
+    async def abort_task(self, task_id):
+        """Abort the task"""
+        self.aborted.append(task_id)
+        for request_id, (_, inflight_task_id) in list(self.inflight.items()):
+            if inflight_task_id == task_id:
+                del self.inflight[request_id]
+
+
+def make_app(inflight):
+    """App with only the state used by drain"""
+    instance = LLMInstructApp.__new__(LLMInstructApp)
+    instance.inflight = inflight
+    instance.start_abort_lock = asyncio.Lock()
+    instance.queue_manager = FakeQueueManager(inflight)
+    return instance
+
+
+def test_drain_waits_for_inflight_generations():
+    """Generations finishing before the timeout are not aborted"""
+
+    async def run():
+        engine = object()
+        instance = make_app({"request": (engine, "task")})
+        asyncio.get_running_loop().call_later(0.2, instance.inflight.clear)
+        await instance.drain(engine, timeout=5.0)
+        return instance
+
+    instance = asyncio.run(run())
+    assert not instance.inflight
+    assert not instance.queue_manager.aborted
+
+
+def test_drain_aborts_generations_on_timeout():
+    """Generations of the drained engine are aborted after the timeout"""
+
+    async def run():
+        engine, other_engine = object(), object()
+        instance = make_app(
+            {
+                "old": (engine, "old_task"),
+                "queued": (engine, None),
+                "new": (other_engine, "new_task"),
+            }
+        )
+        # The queued request leaves once its task is aborted
+        asyncio.get_running_loop().call_later(
+            0.5, instance.inflight.pop, "queued", None
+        )
+        await asyncio.wait_for(instance.drain(engine, timeout=0.2), timeout=5.0)
+        return instance
+
+    instance = asyncio.run(run())
+    assert instance.queue_manager.aborted == ["old_task"]
+    assert list(instance.inflight) == ["new"]
+
+
+def make_admin_request(host, authorization=None):
+    """Request of an admin endpoint"""
+    return types.SimpleNamespace(
+        headers={"authorization": authorization} if authorization else {},
+        client=types.SimpleNamespace(host=host),
+    )
+
+
+def verify_admin(token, request):
+    """Run the admin check, return the HTTP status code of the rejection or None"""
+    instance = LLMInstructApp.__new__(LLMInstructApp)
+    instance.config = omegaconf.OmegaConf.create({"admin_config": {"token": token}})
+    try:
+        asyncio.run(instance.verify_admin(request))
+    except app.HTTPException as error:
+        return error.status_code
+    return None
+
+
+def test_admin_without_token_serves_only_loopback():
+    """Without a token only loopback clients are authorized"""
+    assert verify_admin(None, make_admin_request("127.0.0.1")) is None
+    assert verify_admin(None, make_admin_request("::1")) is None
+    assert verify_admin(None, make_admin_request("10.0.0.1")) == 403
+    assert verify_admin(None, make_admin_request("testclient")) == 403
+
+
+def test_admin_with_token_needs_bearer_token():
+    """With a token every client needs it, including loopback ones"""
+    assert (
+        verify_admin("secret", make_admin_request("10.0.0.1", "Bearer secret")) is None
+    )
+    assert verify_admin("secret", make_admin_request("127.0.0.1")) == 401
+    assert verify_admin("secret", make_admin_request("10.0.0.1", "Bearer wrong")) == 401
+
+
+class FakeEngine:  # pylint: disable=too-few-public-methods
+    """Engine holding conversations only"""
+
+    def __init__(self):
+        self.conversations = {}
+
+
+def test_sweep_expires_detached_sessions():
+    """Detached sessions are expired without a client connecting"""
+
+    async def run():
+        instance = make_app({})
+        instance.config = omegaconf.OmegaConf.create(
+            {"session_config": {"sweep_interval": 0.01}}
+        )
+        instance.sessions = app.SessionManager(ttl=0.01)
+        instance.llm_pipeline = FakeEngine()
+        session = instance.sessions.attach(None)
+        session.generation = app.Generation()
+        session.generation.publish({"task_id": "task"})
+        instance.llm_pipeline.conversations[session.conversation_id] = []
+        instance.sessions.detach(session)
+        await instance.start_session_sweep()
+        await asyncio.sleep(0.2)
+        await instance.stop_session_sweep()
+        return instance
+
+    instance = asyncio.run(run())
+    assert not instance.sessions.sessions
+    assert not instance.llm_pipeline.conversations
+    assert instance.queue_manager.aborted == ["task"]
@@ -0,0 +1,106 @@
+"""Tests of engine utilities"""
+
+# pylint: disable=import-error
+import asyncio
+
+import pytest  # type: ignore
+
+torch = pytest.importorskip("torch")
+engine = pytest.importorskip("AGISwarm.llm_instruct_ms.llm_engines.engine")
+hf_engine = pytest.importorskip("AGISwarm.llm_instruct_ms.llm_engines.hf_engine")
+
+
+class ByteTokenizer:  # pylint: disable=too-few-public-methods
+    """Tokenizer with one token per UTF-8 byte"""
+
+    def __init__(self):
+        self.decoded_lengths = []
+
+    def decode(self, token_ids, **_):
+        """Decode the bytes, replacing incomplete characters"""
+        self.decoded_lengths.append(len(token_ids))
+        return bytes(token_ids).decode("utf-8", errors="replace")
+
+
+def test_best_of_must_not_be_less_than_n():
+    """best_of below n is rejected"""
+    with pytest.raises(ValueError):
+        engine.SamplingParams(n=3, best_of=2)
+    assert engine.SamplingParams(n=2, best_of=2).num_candidates == 2
+    assert engine.SamplingParams(n=2).num_candidates == 2
+
+
+def test_tag_candidate():
+    """Single completions keep the plain text format"""
+    assert engine.tag_candidate(0, "text", 1) == "text"
+    assert engine.tag_candidate(1, "text", 2) == {"index": 1, "text": "text"}
+
+
+class FakeEngine(engine.Engine):  # pylint: disable=too-few-public-methods
+    """Engine streaming two candidates"""
+
+    def __init__(self):
+        self.conversations = {}
+        self.image = {}
+        self.image_prompt_enabled = False
+
+    async def generate(self, *_):
+        """Stream the chunks of the candidates"""
+        yield 0, "a"
+        yield 1, "b"
+        yield 0, "c"
+
+
+def test_engine_tags_every_chunk_of_candidates():
+    """With n > 1 every chunk, including the last one, is tagged"""
+
+    async def run():
+        fake_engine = FakeEngine()
+        chunks = [
+            chunk
+            async for chunk in fake_engine(
+                "conversation", "prompt", "", "", None, engine.SamplingParams(n=2)
+            )
+        ]
+        return fake_engine, chunks
+
+    fake_engine, chunks = asyncio.run(run())
+    assert chunks == [
+        {"index": 0, "text": "a"},
+        {"index": 1, "text": "b"},
+        {"index": 0, "text": "c"},
+        {"index": 0, "text": ""},
+    ]
+    assert fake_engine.conversations["conversation"][-1] == {
+        "role": "assistant",
+        "content": "ac",
+    }
+
+
+def test_candidate_streamer_waits_for_multibyte_characters():
+    """A character split across tokens is streamed once it is complete"""
+    streamer = hf_engine.CandidateStreamer(ByteTokenizer())
+    streamer.put(torch.tensor([[ord("p")]]))  # prompt
+    for step in ([ord("a"), ord("b")], [0xC3, ord("c")], [0xA9, ord("d")]):
+        streamer.put(torch.tensor(step))
+    streamer.end()
+    assert list(streamer) == [
+        (0, "a"),
+        (1, "b"),
+        (1, "c"),
+        (0, "é"),
+        (1, "d"),
+    ]
+
+
+def test_candidate_streamer_decodes_a_bounded_window():
+    """Every step decodes only the recent tokens, not the whole sequence"""
+    tokenizer = ByteTokenizer()
+    streamer = hf_engine.CandidateStreamer(tokenizer)
+    streamer.put(torch.tensor([[ord("p")]]))  # prompt
+    text = "héllo wörld " * 100
+    for byte in text.encode("utf-8"):
+        streamer.put(torch.tensor([byte]))
+    streamer.end()
+    assert "".join(chunk for _, chunk in streamer) == text
+    assert max(tokenizer.decoded_lengths) <= 3
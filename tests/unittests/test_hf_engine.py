@@ -0,0 +1,45 @@
+"""Tests of HFEngine load options"""
+
+# pylint: disable=import-error
+import types
+
+import pytest  # type: ignore
+
+torch = pytest.importorskip("torch")
+hf_engine = pytest.importorskip("AGISwarm.llm_instruct_ms.llm_engines.hf_engine")
+
+
+@pytest.fixture(name="model_config")
+def fixture_model_config(monkeypatch):
+    """Model config returned by AutoConfig.from_pretrained"""
+    model_config = types.SimpleNamespace()
+    monkeypatch.setattr(
+        hf_engine.transformers.AutoConfig,
+        "from_pretrained",
+        lambda hf_model_name: model_config,
+    )
+    return model_config
+
+
+def test_unquantized_model_is_quantized_on_request(model_config):
+    """load_in_4bit quantizes an unquantized model with BNB_CONFIG"""
+    assert not hasattr(model_config, "quantization_config")
+    assert hf_engine.get_quantization_config("model", True) is hf_engine.BNB_CONFIG
+    assert hf_engine.get_quantization_config("model", False) is None
+
+
+def test_pre_quantized_model_keeps_its_quantization(model_config):
+    """Pre-quantized models are loaded with the quantization of their config"""
+    model_config.quantization_config = {"quant_method": "gptq"}
+    assert hf_engine.get_quantization_config("model", True) is None
+    assert hf_engine.get_quantization_config("model", False) is None
+
+
+def test_torch_dtype():
+    """torch_dtype names a torch dtype, None and "auto" are passed as is"""
+    assert hf_engine.get_torch_dtype("bfloat16") is torch.bfloat16
+    assert hf_engine.get_torch_dtype(None) is None
+    assert hf_engine.get_torch_dtype("auto") == "auto"
+    for torch_dtype in ("nn", "bfloat61"):
+        with pytest.raises(ValueError, match="torch_dtype"):
+            hf_engine.get_torch_dtype(torch_dtype)
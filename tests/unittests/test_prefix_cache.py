@@ -0,0 +1,53 @@
+"""Tests of the prefix cache for pinned system prompts"""
+
+# pylint: disable=import-error
+import pytest  # type: ignore
+
+prefix_cache = pytest.importorskip("AGISwarm.llm_instruct_ms.llm_engines.prefix_cache")
+
+
+def test_lookup_returns_longest_prefix():
+    """The longest pinned prefix of the tokens is returned"""
+    cache = prefix_cache.PrefixCache()
+    cache.pin([1, 2], "short")
+    cache.pin([1, 2, 3, 4], "long")
+    cache.pin([1, 5, 6], "other")
+    assert cache.lookup([1, 2, 3, 4, 7]) == (4, "long")
+    assert cache.lookup([1, 2, 3, 7]) == (2, "short")
+    assert cache.hits == 2
+    assert cache.misses == 0
+
+
+def test_lookup_leaves_a_token_to_compute():
+    """A prefix equal to the whole prompt is not a hit"""
+    cache = prefix_cache.PrefixCache()
+    cache.pin([1, 2, 3], "state")
+    assert cache.lookup([1, 2, 3]) is None
+    assert cache.lookup([4, 2, 3, 5]) is None
+    assert cache.misses == 2
+
+
+def test_disabled_cache_is_not_counted():
+    """Lookups without pinned prefixes are neither hits nor misses"""
+    cache = prefix_cache.PrefixCache()
+    assert cache.lookup([1, 2, 3]) is None
+    metrics = cache.metrics()
+    assert metrics["enabled"] is False
+    assert metrics["hits"] == metrics["misses"] == 0
+    assert metrics["hit_rate"] is None
+
+
+def test_metrics():
+    """Hit rate and mean TTFT are reported per hit and miss"""
+    cache = prefix_cache.PrefixCache()
+    cache.pin([1, 2], "state")
+    cache.lookup([1, 2, 3])
+    cache.lookup([3, 2, 1])
+    cache.record_ttft(True, 1.0)
+    cache.record_ttft(True, 3.0)
+    metrics = cache.metrics()
+    assert metrics["enabled"] is True
+    assert metrics["pinned_prefixes"] == 1
+    assert metrics["hit_rate"] == 0.5
+    assert metrics["ttft_hit_mean"] == 2.0
+    assert metrics["ttft_miss_mean"] is None
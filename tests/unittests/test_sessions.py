@@ -0,0 +1,73 @@
+"""Tests of conversation sessions"""
+
+# pylint: disable=import-error
+import asyncio
+
+import pytest  # type: ignore
+
+from AGISwarm.llm_instruct_ms import sessions
+from AGISwarm.llm_instruct_ms.sessions import Generation, SessionManager
+
+
+@pytest.fixture(name="clock")
+def fixture_clock(monkeypatch):
+    """Controllable monotonic clock"""
+    now = [100.0]
+    monkeypatch.setattr(sessions.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_reattach_within_ttl(clock):
+    """A detached session is reattached by its token before the TTL expires"""
+    manager = SessionManager(ttl=10.0)
+    session = manager.attach(None)
+    manager.detach(session)
+    clock[0] += 5.0
+    assert not manager.pop_expired()
+    assert manager.attach(session.token) is session
+    assert session.expires_at is None
+
+
+def test_session_expires_after_ttl(clock):
+    """A detached session expires after the TTL and its token is not reused"""
+    manager = SessionManager(ttl=10.0)
+    session = manager.attach(None)
+    manager.detach(session)
+    clock[0] += 11.0
+    new_session = manager.attach(session.token)
+    assert new_session is not session
+    assert manager.pop_expired() == [session]
+    assert session.token not in manager.sessions
+
+
+def test_connected_session_does_not_expire(clock):
+    """A session expires only once its last client detaches"""
+    manager = SessionManager(ttl=10.0)
+    session = manager.attach(None)
+    manager.attach(session.token)
+    manager.detach(session)
+    clock[0] += 11.0
+    assert not manager.pop_expired()
+
+
+def test_generation_stream_replays_from_offset():
+    """A reattached client receives the buffered steps from offset, then the new ones"""
+
+    async def run():
+        generation = Generation()
+        for step in range(3):
+            generation.publish({"step": step})
+        received = []
+
+        async def consume():
+            async for step_info in generation.stream(offset=1):
+                received.append(step_info["step"])
+
+        consumer = asyncio.create_task(consume())
+        await asyncio.sleep(0)
+        generation.publish({"step": 3})
+        generation.finish()
+        await asyncio.wait_for(consumer, timeout=1.0)
+        return received
+
+    assert asyncio.run(run()) == [1, 2, 3]
@@ -0,0 +1,48 @@
+"""Tests of per-request tracing"""
+
+# pylint: disable=import-error
+import json
+
+from AGISwarm.llm_instruct_ms.tracing import NOOP_SPAN, Tracer
+
+
+def test_disabled_tracer_returns_noop_span():
+    """Spans are not recorded until a file is configured"""
+    assert Tracer().start_span("request") is NOOP_SPAN
+
+
+def test_otlp_line_shape(tmp_path):
+    """Every span is exported as one OTLP JSON line with its parent linked"""
+    file = tmp_path / "traces.jsonl"
+    tracer = Tracer(service_name="test_service")
+    tracer.configure(str(file))
+    with tracer.start_span("request", request_id="abc"):
+        with tracer.start_span("prefill", prompt_tokens=3, hit=True, ratio=0.5):
+            pass
+    tracer.configure(None)
+
+    lines = file.read_text(encoding="utf-8").splitlines()
+    assert len(lines) == 2
+    child_request, parent_request = (json.loads(line) for line in lines)
+    resource_spans = child_request["resourceSpans"][0]
+    assert resource_spans["resource"]["attributes"] == [
+        {"key": "service.name", "value": {"stringValue": "test_service"}}
+    ]
+    scope_spans = resource_spans["scopeSpans"][0]
+    assert scope_spans["scope"] == {"name": "AGISwarm.llm_instruct_ms"}
+    (child,) = scope_spans["spans"]
+    (root,) = parent_request["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert child["name"] == "prefill"
+    assert child["traceId"] == root["traceId"]
+    assert child["parentSpanId"] == root["spanId"]
+    assert int(child["startTimeUnixNano"]) <= int(child["endTimeUnixNano"])
+    assert child["attributes"] == [
+        {"key": "prompt_tokens", "value": {"intValue": "3"}},
+        {"key": "hit", "value": {"boolValue": True}},
+        {"key": "ratio", "value": {"doubleValue": 0.5}},
+    ]
+    assert root["name"] == "request"
+    assert root["parentSpanId"] == ""
+    assert root["attributes"] == [
+        {"key": "request_id", "value": {"stringValue": "abc"}}
+    ]